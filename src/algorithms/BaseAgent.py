@@ -21,6 +21,10 @@ class BaseAgent(RlGlue.agent.BaseAgent):
     def cleanup(self):
         ...
 
+    # release any resources held by the agent (e.g. worker threads) once a run is finished
+    def close(self):
+        ...
+
     # -------------------
     # -- Checkpointing --
     # -------------------
@@ -5,7 +5,7 @@ from ReplayTables.ReplayBuffer import Batch
 
 from algorithms.nn.NNAgent import NNAgent
 from representations.networks import NetworkBuilder
-from utils.jax import huber_loss
+from utils.jax import cast_floats, huber, takeAlongAxis
 
 import jax
 import chex
@@ -22,13 +22,16 @@ class AgentState:
     optim: optax.OptState
 
 
+# operates on a whole minibatch at once: q and qp are (batch, actions)
 def q_loss(q, a, r, gamma, qp):
-    vp = qp.max()
+    vp = qp.max(axis=-1)
     target = r + gamma * vp
     target = jax.lax.stop_gradient(target)
-    delta = target - q[a]
 
-    return huber_loss(1.0, q[a], target), {
+    qa = takeAlongAxis(q, a)
+    delta = target - qa
+
+    return huber(1.0, qa, target), {
         'delta': delta,
     }
 
@@ -38,80 +41,112 @@ class DQN(NNAgent):
         # set up the target network parameters
         self.target_refresh = params['target_refresh']
 
-        self.state = AgentState(
-            params=self.state.params,
-            target_params=self.state.params,
-            optim=self.state.optim,
-        )
-
     # ------------------------
     # -- NN agent interface --
     # ------------------------
     def _build_heads(self, builder: NetworkBuilder) -> None:
         self.q = builder.addHead(lambda: hk.Linear(self.actions, name='q'))
 
+    # the target is only ever used in the forward pass
+    # so it is stored directly in the compute dtype.
+    # It also needs its own buffers, because params are donated on every update
+    def _init_state(self, params: hk.Params, optim: optax.OptState):
+        target_params = jax.tree_util.tree_map(jnp.copy, cast_floats(params, self.compute_dtype))
+
+        return AgentState(
+            params=params,
+            target_params=target_params,
+            optim=optim,
+        )
+
     # internal compiled version of the value function
     @partial(jax.jit, static_argnums=0)
-    def _values(self, state: AgentState, x: jax.Array):
-        phi = self.phi(state.params, x).out
-        return self.q(state.params, phi)
+    def _values(self, params: hk.Params, x: jax.Array):
+        phi = self.phi(params, x).out
+        return self.q(params, phi)
 
     def update(self):
         self.steps += 1
 
         # only update every `update_freq` steps
-        if self.steps % self.update_freq != 0:
+        if self.steps % (self.update_freq * self.n_jitted_steps) != 0:
             return
 
         # skip updates if the buffer isn't full yet
         if self.buffer.size() <= self.batch_size:
             return
 
+        if self.n_jitted_steps > 1:
+            return self._updateK()
+
         self.updates += 1
 
-        batch = self.buffer.sample(self.batch_size)
-        weights = self.buffer.isr_weights(batch.eid)
-        self.state, metrics = self._computeUpdate(self.state, batch, weights)
+        sampled, batch = self._sample_batch()
+        weights = self.buffer.isr_weights(sampled.eid)
+        self.state, metrics = self._computeUpdate(
+            self.state.params,
+            self.state.optim,
+            self.state.target_params,
+            batch,
+            weights,
+            self.updates,
+        )
 
         metrics = jax.device_get(metrics)
 
         priorities = metrics['delta']
-        self.buffer.update_batch(batch, priorities=priorities)
+        self.buffer.update_batch(sampled, priorities=priorities)
 
         for k, v in metrics.items():
             self.collector.collect(k, np.mean(v).item())
 
-        if self.updates % self.target_refresh == 0:
-            self.state.target_params = self.state.params
-
     # -------------
     # -- Updates --
     # -------------
-    @partial(jax.jit, static_argnums=0)
-    def _computeUpdate(self, state: AgentState, batch: Batch, weights: jax.Array):
+    def _learn(self, state: AgentState, batch: Batch, weights: jax.Array, updates: jax.Array):
+        return self._computeUpdate(state.params, state.optim, state.target_params, batch, weights, updates)
+
+    # `step` counts this update, so the target is refreshed
+    # on the same schedule as it was when synced from python.
+    # params and optimizer state are donated so XLA can update them in place,
+    # the target is read-only on most steps so it is not
+    @partial(jax.jit, static_argnums=0, donate_argnums=(1, 2))
+    def _computeUpdate(self, params: hk.Params, optim: optax.OptState, target_params: hk.Params, batch: Batch, weights: jax.Array, step: jax.Array | int):
         grad_fn = jax.grad(self._loss, has_aux=True)
-        grad, metrics = grad_fn(state.params, state.target_params, batch, weights)
+        grad, metrics = grad_fn(params, target_params, batch, weights)
 
-        updates, optim = self.optimizer.update(grad, state.optim, state.params)
-        params = optax.apply_updates(state.params, updates)
+        updates, optim = self.optimizer.update(grad, optim, params)
+        params = optax.apply_updates(params, updates)
+
+        # keep the refresh on-device rather than rebinding the target from python
+        new_target = jax.lax.cond(
+            step % self.target_refresh == 0,
+            lambda: cast_floats(params, self.compute_dtype),
+            lambda: target_params,
+        )
 
         new_state = AgentState(
             params=params,
-            target_params=state.target_params,
+            target_params=new_target,
             optim=optim,
         )
 
         return new_state, metrics
 
     def _loss(self, params: hk.Params, target: hk.Params, batch: Batch, weights: jax.Array):
-        phi = self.phi(params, batch.x).out
-        phi_p = self.phi(target, batch.xp).out
+        # run the networks in the compute dtype. Gradients flow back through
+        # the cast, so they arrive in float32 for the master params
+        params = cast_floats(params, self.compute_dtype)
+        x = batch.x.astype(self.compute_dtype)
+        xp = batch.xp.astype(self.compute_dtype)
+
+        phi = self.phi(params, x).out
+        phi_p = self.phi(target, xp).out
 
-        qs = self.q(params, phi)
-        qsp = self.q(target, phi_p)
+        qs = self.q(params, phi).astype(jnp.float32)
+        qsp = self.q(target, phi_p).astype(jnp.float32)
 
-        batch_loss = jax.vmap(q_loss, in_axes=0)
-        losses, metrics = batch_loss(qs, batch.a, batch.r, batch.gamma, qsp)
+        losses, metrics = q_loss(qs, batch.a, batch.r, batch.gamma, qsp)
 
         chex.assert_equal_shape((weights, losses))
         loss = jnp.mean(weights * losses)
@@ -5,12 +5,13 @@ from ReplayTables.interface import Batch
 
 from algorithms.nn.NNAgent import NNAgent, AgentState
 from representations.networks import NetworkBuilder
-from utils.jax import vmap_except, argmax_with_random_tie_breaking
+from utils.jax import cast_floats, takeAlongAxis, egreedy_with_random_tie_breaking
 
 import jax
 import optax
 import numpy as np
 import haiku as hk
+import jax.numpy as jnp
 import utils.hk as hku
 
 tree_leaves = jax.tree_util.tree_leaves
@@ -33,28 +34,33 @@ class EQRC(NNAgent):
     # jit'ed internal value function approximator
     # considerable speedup, especially for larger networks (note: haiku networks are not jit'ed by default)
     @partial(jax.jit, static_argnums=0)
-    def _values(self, state: AgentState, x: jax.Array):
-        phi = self.phi(state.params, x).out
-        return self.q(state.params, phi)
+    def _values(self, params: hk.Params, x: jax.Array):
+        phi = self.phi(params, x).out
+        return self.q(params, phi)
 
     def update(self):
         self.steps += 1
 
         # only update every `update_freq` steps
-        if self.steps % self.update_freq != 0:
+        if self.steps % (self.update_freq * self.n_jitted_steps) != 0:
             return
 
         # skip updates if the buffer isn't full yet
         if self.buffer.size() <= self.batch_size:
             return
 
-        batch = self.buffer.sample(self.batch_size)
+        if self.n_jitted_steps > 1:
+            return self._updateK()
+
+        self.updates += 1
+
+        sampled, batch = self._sample_batch()
         self.state, metrics = self._computeUpdate(self.state, batch)
 
         metrics = jax.device_get(metrics)
 
         priorities = metrics['delta']
-        self.buffer.update_batch(batch, priorities=priorities)
+        self.buffer.update_batch(sampled, priorities=priorities)
 
         for k, v in metrics.items():
             self.collector.collect(k, np.mean(v).item())
@@ -62,10 +68,13 @@ class EQRC(NNAgent):
     # -------------
     # -- Updates --
     # -------------
+    def _learn(self, state: AgentState, batch: Batch, weights: jax.Array, updates: jax.Array):
+        return self._computeUpdate(state, batch)
 
     # compute the update and return the new parameter states
     # and optimizer state (i.e. ADAM moving averages)
-    @partial(jax.jit, static_argnums=0)
+    # the incoming state is donated so XLA can update it in place
+    @partial(jax.jit, static_argnums=0, donate_argnums=1)
     def _computeUpdate(self, state: AgentState, batch: Batch):
         params = state.params
         grad, metrics = jax.grad(self._loss, has_aux=True)(params, batch)
@@ -91,45 +100,52 @@ class EQRC(NNAgent):
 
     # compute the total QRC loss for both sets of parameters (value parameters and h parameters)
     def _loss(self, params, batch: Batch):
-        phi = self.phi(params, batch.x).out
-        q = self.q(params, phi)
-        h = self.h(params, phi)
+        # run the networks in the compute dtype. Gradients flow back through
+        # the cast, so they arrive in float32 for the master params
+        params = cast_floats(params, self.compute_dtype)
+        x = batch.x.astype(self.compute_dtype)
+        xp = batch.xp.astype(self.compute_dtype)
 
-        phi_p = self.phi(params, batch.xp).out
-        qp = self.q(params, phi_p)
+        # x and xp go through the same network with the same params
+        # so run them as a single stacked batch, then split the outputs
+        n = x.shape[0]
+        phi = self.phi(params, jnp.concatenate((x, xp))).out
+        qs = self.q(params, phi).astype(jnp.float32)
+
+        q, qp = qs[:n], qs[n:]
+        h = self.h(params, phi[:n]).astype(jnp.float32)
 
         # apply qc loss function to each sample in the minibatch
         # gives back value of the loss individually for parameters of v and h
         # note QC instead of QRC (i.e. no regularization)
         v_loss, h_loss, metrics = qc_loss(q, batch.a, batch.r, batch.gamma, qp, h, self.epsilon)
 
-        h_loss = h_loss.mean()
-        v_loss = v_loss.mean()
+        # a single reduction for the whole objective
+        loss = jnp.mean(v_loss + h_loss)
 
+        # per-sample losses are averaged on the host when they are collected
         metrics |= {
             'v_loss': v_loss,
             'h_loss': h_loss,
         }
 
-        return v_loss + h_loss, metrics
+        return loss, metrics
 
 # ---------------
 # -- Utilities --
 # ---------------
 
-@partial(vmap_except, exclude=['epsilon'])
+# operates on a whole minibatch at once: q, qtp1 and h are (batch, actions)
 def qc_loss(q, a, r, gamma, qtp1, h, epsilon):
-    pi = argmax_with_random_tie_breaking(qtp1)
-
-    pi = (1.0 - epsilon) * pi + (epsilon / qtp1.shape[0])
+    pi = egreedy_with_random_tie_breaking(qtp1, epsilon)
     pi = jax.lax.stop_gradient(pi)
 
-    vtp1 = qtp1.dot(pi)
+    vtp1 = jnp.sum(qtp1 * pi, axis=-1)
     target = r + gamma * vtp1
     target = jax.lax.stop_gradient(target)
 
-    delta = target - q[a]
-    delta_hat = h[a]
+    delta = target - takeAlongAxis(q, a)
+    delta_hat = takeAlongAxis(h, a)
 
     v_loss = 0.5 * delta**2 + gamma * jax.lax.stop_gradient(delta_hat) * vtp1
     h_loss = 0.5 * (jax.lax.stop_gradient(delta) - delta_hat)**2
@@ -1,10 +1,13 @@
 import jax
 import optax
 import numpy as np
+import jax.numpy as jnp
 import utils.chex as cxu
 
 from abc import abstractmethod
-from typing import Any, Dict, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, NamedTuple, Tuple
 from PyExpUtils.collection.Collector import Collector
 from ReplayTables.interface import Timestep
 from ReplayTables.registry import build_buffer
@@ -12,13 +15,36 @@ from ReplayTables.registry import build_buffer
 from algorithms.BaseAgent import BaseAgent
 from representations.networks import NetworkBuilder
 from utils.checkpoint import checkpointable
+from utils.jax import Batch
 from utils.policies import egreedy_probabilities, sample
+from utils.replay import ReplayState, RingBuffer, as_batch, init_replay, add_transition, sample_batch, obs_scale, quantize_obs, dequantize_obs
+
+tree_map = jax.tree_util.tree_map
+tree_leaves = jax.tree_util.tree_leaves
+tree_structure = jax.tree_util.tree_structure
+tree_unflatten = jax.tree_util.tree_unflatten
 
 @cxu.dataclass
 class AgentState:
     params: Any
     optim: optax.OptState
 
+# carry for the compiled training loop
+# holds everything that changes from one step to the next
+@cxu.dataclass
+class TrainState:
+    state: Any
+    replay: ReplayState
+    key: jax.Array
+    steps: jax.Array
+    updates: jax.Array
+
+
+# all the host keeps of a prefetched minibatch
+# uniform replay only needs the ids, for its (unit) importance weights
+class StagedIds(NamedTuple):
+    eid: np.ndarray
+
 
 @checkpointable(('buffer', 'steps', 'state', 'updates'))
 class NNAgent(BaseAgent):
@@ -34,6 +60,10 @@ class NNAgent(BaseAgent):
         self.epsilon = params['epsilon']
         self.reward_clip = params.get('reward_clip', 0)
 
+        # dtype of the forward/backward pass inside the loss (e.g. "bfloat16")
+        # master params, optimizer state and the loss itself stay in float32
+        self.compute_dtype = jnp.dtype(params.get('compute_dtype', 'float32'))
+
         # ---------------------
         # -- NN Architecture --
         # ---------------------
@@ -41,6 +71,7 @@ class NNAgent(BaseAgent):
         self._build_heads(builder)
         self.phi = builder.getFeatureFunction()
         net_params = builder.getParams()
+        self._init_params = builder.getInitializer()
 
         # ---------------
         # -- Optimizer --
@@ -59,25 +90,65 @@ class NNAgent(BaseAgent):
         self.batch_size = params['batch']
         self.update_freq = params.get('update_freq', 1)
 
-        self.buffer = build_buffer(
-            buffer_type=params['buffer_type'],
-            max_size=self.buffer_size,
-            lag=self.n_step,
-            rng=self.rng,
-            config=params.get('buffer_config', {}),
-        )
+        # compile this many consecutive updates into a single call
+        # they are then all applied together every `n_jitted_steps` update opportunities
+        self.n_jitted_steps = params.get('n_jitted_steps', 1)
+
+        self.buffer_type = params['buffer_type']
+
+        # storage dtype for replayed observations (e.g. "uint8")
+        # a narrower dtype shrinks both replay memory and host->device traffic.
+        # Integer dtypes quantize observations from [0, 1], e.g. round(x * 255) for uint8.
+        # They are mapped back to [0, 1] on-device at the start of the feature network,
+        # and acting quantizes its inputs the same way, so acting and learning see identical states
+        self.obs_dtype = params.get('obs_dtype')
+        self._obs_scale = obs_scale(self.obs_dtype)
+        assert self.obs_dtype is None or self.buffer_type == 'uniform', 'obs_dtype is only supported for uniform replay'
+
+        if self._obs_scale != 1:
+            phi = self.phi
+            self.phi = lambda params, x: phi(params, dequantize_obs(x, self._obs_scale))
+
+        # optionally sample and stage the next minibatch on a background thread
+        # while the current update runs. Priorities must be written back before
+        # the next sample, so this is only supported for uniform replay.
+        # Multi-step updates draw all of their minibatches in one call instead
+        self.prefetch = params.get('prefetch', False) and self.buffer_type == 'uniform' and self.n_jitted_steps == 1
+        self._prefetcher = ThreadPoolExecutor(max_workers=1) if self.prefetch else None
+        self._next_batch: Future | None = None
+
+        # uniform replay is common enough to get a dedicated array-backed buffer
+        # prioritized variants still go through ReplayTables
+        if self.buffer_type == 'uniform':
+            # background sampling gets its own stream so runs stay reproducible
+            buffer_rng = np.random.default_rng(self.rng.integers(2**31)) if self.prefetch else self.rng
+            self.buffer = RingBuffer(
+                max_size=self.buffer_size,
+                observations=self.observations,
+                lag=self.n_step,
+                rng=buffer_rng,
+                obs_dtype=self.obs_dtype,
+            )
+
+        else:
+            self.buffer = build_buffer(
+                buffer_type=self.buffer_type,
+                max_size=self.buffer_size,
+                lag=self.n_step,
+                rng=self.rng,
+                config=params.get('buffer_config', {}),
+            )
 
         # --------------------------
         # -- Stateful information --
         # --------------------------
-        self.state = AgentState(
-            params=net_params,
-            optim=opt_state,
-        )
+        self.state = self._init_state(net_params, opt_state)
 
         self.steps = 0
         self.updates = 0
 
+        self._values_cache: Dict[Tuple, Any] = {}
+
     # ------------------------
     # -- NN agent interface --
     # ------------------------
@@ -86,14 +157,38 @@ class NNAgent(BaseAgent):
     def _build_heads(self, builder: NetworkBuilder) -> None:
         ...
 
+    # agents that carry extra state (e.g. target networks) should override this
+    def _init_state(self, params: Any, optim: optax.OptState) -> Any:
+        return AgentState(
+            params=params,
+            optim=optim,
+        )
+
     @abstractmethod
-    def _values(self, state: Any, x: np.ndarray) -> jax.Array:
+    def _values(self, params: Any, x: np.ndarray) -> jax.Array:
         ...
 
     @abstractmethod
     def update(self) -> None:
         ...
 
+    # apply a single update to the agent state given a minibatch
+    # used by the compiled training loops, so must be traceable
+    @abstractmethod
+    def _learn(self, state: Any, batch: Batch, weights: jax.Array, updates: jax.Array) -> Tuple[Any, Dict[str, jax.Array]]:
+        ...
+
+    # the online params are flattened once each time the state is rebound
+    # rather than walking the nested dict on every action
+    @property
+    def state(self) -> Any:
+        return self._state
+
+    @state.setter
+    def state(self, state: Any):
+        self._state = state
+        self._params_leaves = tree_leaves(state.params)
+
     def policy(self, obs: np.ndarray) -> np.ndarray:
         q = self.values(obs)
         pi = egreedy_probabilities(q, self.actions, self.epsilon)
@@ -104,23 +199,216 @@ class NNAgent(BaseAgent):
     # --------------------------
     def values(self, x: np.ndarray):
         x = np.asarray(x)
+        if self.obs_dtype is not None:
+            x = quantize_obs(x, self.obs_dtype)
+
+        # acting only needs the online params, passed as a flat list of leaves
+        leaves = self._params_leaves
 
         # if x is a vector, then jax handles a lack of "batch" dimension gracefully
         #   at a 5x speedup
         # if x is a tensor, jax does not handle lack of "batch" dim gracefully
         if len(x.shape) > 1:
             x = np.expand_dims(x, 0)
-            q = self._values(self.state, x)[0]
+            q = self._compiledValues(x)(leaves, x)[0]
 
         else:
-            q = self._values(self.state, x)
+            q = self._compiledValues(x)(leaves, x)
 
         return jax.device_get(q)
 
+    # ahead-of-time compile `_values` once per observation shape and dtype
+    # so that acting never goes back through jit's tracing cache.
+    # The compiled function takes the params as flat leaves and rebuilds
+    # the nested dict at trace time only
+    def _compiledValues(self, x: np.ndarray):
+        sig = (x.shape, x.dtype)
+        f = self._values_cache.get(sig)
+        if f is None:
+            treedef = tree_structure(self.state.params)
+
+            def _apply(leaves, x):
+                params = tree_unflatten(treedef, leaves)
+                return self._values(params, x)
+
+            f = jax.jit(_apply).lower(self._params_leaves, x).compile()
+            self._values_cache[sig] = f
+
+        return f
+
+    # -------------------
+    # -- Batch staging --
+    # -------------------
+    # gives back the sampled minibatch as the host-side part needed for
+    # importance weights and priority write-back, and the loss columns
+    def _sample_batch(self) -> Tuple[Any, Batch]:
+        if self._prefetcher is None:
+            sampled = self.buffer.sample(self.batch_size)
+            return sampled, as_batch(sampled)
+
+        if self._next_batch is None:
+            staged = self._stage_batch()
+        else:
+            staged = self._next_batch.result()
+
+        # the next minibatch is sampled and copied to device while this one is consumed.
+        # It is drawn now, so it misses the `update_freq` transitions added before it is used
+        self._next_batch = self._prefetcher.submit(self._stage_batch)
+        return staged
+
+    # only the loss columns go to the device, the ids stay on the host
+    def _stage_batch(self) -> Tuple[StagedIds, Batch]:
+        sampled = self.buffer.sample(self.batch_size)
+        return StagedIds(eid=sampled.eid), jax.device_put(as_batch(sampled))
+
+    # the buffer must not be written while a prefetch is reading from it
+    def _wait_for_prefetch(self):
+        if self._next_batch is not None:
+            self._next_batch.result()
+
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=True)
+
+    # -------------------------------
+    # -- Multi-step jitted updates --
+    # -------------------------------
+    # sample `n_jitted_steps` minibatches and apply them as one compiled call
+    def _updateK(self):
+        k = self.n_jitted_steps
+
+        # the ring buffer draws all k minibatches at once, already stacked
+        if isinstance(self.buffer, RingBuffer):
+            sampled = self.buffer.sample_k(self.batch_size, k)
+            weights = self.buffer.isr_weights(sampled.eid)
+            stacked = as_batch(sampled)
+            batches = []
+
+        else:
+            batches = [self.buffer.sample(self.batch_size) for _ in range(k)]
+            weights = np.stack([self.buffer.isr_weights(b.eid) for b in batches])
+            stacked = tree_map(lambda *xs: np.stack(xs), *map(as_batch, batches))
+
+        self.state, metrics = self._computeUpdateK(self.state, stacked, weights, self.updates)
+        self.updates += k
+
+        metrics = jax.device_get(metrics)
+
+        # priorities for the whole group are only written back after all k updates
+        # uniform replay has no priorities to write
+        for batch, priorities in zip(batches, metrics['delta']):
+            self.buffer.update_batch(batch, priorities=priorities)
+
+        # one value per update, as with single updates, so the
+        # collected series do not thin out as `n_jitted_steps` grows
+        for key, v in metrics.items():
+            for row in v:
+                self.collector.collect(key, np.mean(row).item())
+
+    @partial(jax.jit, static_argnums=0, donate_argnums=1)
+    def _computeUpdateK(self, state: Any, batches: Any, weights: jax.Array, updates: jax.Array | int):
+        def _step(carry, xs):
+            state, updates = carry
+            batch, w = xs
+
+            updates = updates + 1
+            state, metrics = self._learn(state, batch, w, updates)
+            return (state, updates), metrics
+
+        (state, _), metrics = jax.lax.scan(_step, (state, updates), (batches, weights))
+        return state, metrics
+
+    # ----------------------------
+    # -- Compiled training loop --
+    # ----------------------------
+    # a fresh agent built purely from `key`, so this can be vmapped over seeds
+    def init_train_state(self, key: jax.Array) -> TrainState:
+        key, params_key = jax.random.split(key)
+        params = self._init_params(params_key)
+        optim = self.optimizer.init(params)
+
+        return self._make_train_state(self._init_state(params, optim), key, 0, 0)
+
+    # continue from the agent's current learning state with an empty on-device replay.
+    # `rollout` donates its carry, so the carry gets its own copy of the agent state
+    def get_train_state(self, key: jax.Array) -> TrainState:
+        state = tree_map(jnp.copy, self.state)
+        return self._make_train_state(state, key, self.steps, self.updates)
+
+    # hand a carry back to the agent so that `values` and `policy` act with it.
+    # Copied for the same reason as above: the next `rollout` will consume `carry`
+    def set_train_state(self, carry: TrainState) -> None:
+        self.state = tree_map(jnp.copy, carry.state)
+        self.steps = int(carry.steps)
+        self.updates = int(carry.updates)
+
+    def _make_train_state(self, state: Any, key: jax.Array, steps: int, updates: int) -> TrainState:
+        # the on-device replay is a plain uniform buffer of one-step transitions
+        # so refuse to silently train something other than what was configured
+        assert self.buffer_type == 'uniform', 'The compiled training loop only supports uniform replay'
+        assert self.n_step == 1, 'The compiled training loop only supports one-step returns'
+
+        # transitions are stored as given, so a narrower dtype could only be reached by
+        # casting under jit, where bad values can't be rejected the way RingBuffer does
+        assert self.obs_dtype is None, 'The compiled training loop does not support obs_dtype'
+
+        return TrainState(
+            state=state,
+            replay=init_replay(self.buffer_size, self.observations),
+            key=key,
+            steps=jnp.array(steps, dtype=jnp.int32),
+            updates=jnp.array(updates, dtype=jnp.int32),
+        )
+
+    # one environment step worth of learning: store the transition, then
+    # possibly sample a minibatch and update. Everything stays on-device
+    def _train_step(self, carry: TrainState, transition: Batch):
+        replay = add_transition(carry.replay, transition)
+        key, sample_key = jax.random.split(carry.key)
+        steps = carry.steps + 1
+
+        # same schedule as `update`: only every `update_freq` steps
+        # and only once the buffer holds more than a single batch
+        should_update = (steps % self.update_freq == 0) & (replay.size > self.batch_size)
+
+        def _update():
+            updates = carry.updates + 1
+            batch = sample_batch(replay, sample_key, self.batch_size)
+            weights = jnp.ones(self.batch_size)
+            state, metrics = self._learn(carry.state, batch, weights, updates)
+            return state, updates, metrics['delta']
+
+        def _skip():
+            return carry.state, carry.updates, jnp.zeros(self.batch_size)
+
+        state, updates, delta = jax.lax.cond(should_update, _update, _skip)
+
+        new_carry = TrainState(
+            state=state,
+            replay=replay,
+            key=key,
+            steps=steps,
+            updates=updates,
+        )
+
+        return new_carry, delta
+
+    # drive `_train_step` over a stack of transitions with leading axis N
+    # so that N environment steps cost a single dispatch from python.
+    # The carry is donated so the replay arrays are updated in place.
+    # e.g. a driver collecting N steps at a time:
+    #   carry = agent.init_train_state(key)
+    #   carry, _ = agent.rollout(carry, transitions)
+    #   agent.set_train_state(carry)
+    @partial(jax.jit, static_argnums=0, donate_argnums=1)
+    def rollout(self, carry: TrainState, transitions: Batch):
+        return jax.lax.scan(self._train_step, carry, transitions)
+
     # ----------------------
     # -- RLGlue interface --
     # ----------------------
     def start(self, x: np.ndarray):
+        self._wait_for_prefetch()
         self.buffer.flush()
         x = np.asarray(x)
         pi = self.policy(x)
@@ -150,6 +438,7 @@ class NNAgent(BaseAgent):
         if self.reward_clip > 0:
             r = np.clip(r, -self.reward_clip, self.reward_clip)
 
+        self._wait_for_prefetch()
         self.buffer.add_step(Timestep(
             x=xp,
             a=a,
@@ -166,8 +455,12 @@ class NNAgent(BaseAgent):
         if self.reward_clip > 0:
             r = np.clip(r, -self.reward_clip, self.reward_clip)
 
+        self._wait_for_prefetch()
+
+        # terminal transitions have no next state. The buffers bootstrap them
+        # from a reserved all-zero state, which gamma=0 masks out of the losses
         self.buffer.add_step(Timestep(
-            x=np.zeros(self.observations),
+            x=None,
             a=-1,
             r=r,
             gamma=0,
@@ -175,3 +468,22 @@ class NNAgent(BaseAgent):
         ))
 
         self.update()
+
+
+# ------------------------------
+# -- Functional training APIs --
+# ------------------------------
+
+# train a freshly initialized agent over a fixed stream of transitions
+def train(agent: NNAgent, key: jax.Array, transitions: Batch) -> TrainState:
+    carry = agent.init_train_state(key)
+    carry, _ = jax.lax.scan(agent._train_step, carry, transitions)
+    return carry
+
+# train one independent agent per key as a single compiled program.
+# Seeds share the transition stream but differ in network initialization
+# and replay sampling; every leaf of the result gains a leading seed axis.
+# e.g. train_seeds(agent, jax.random.split(key, 30), transitions)
+@partial(jax.jit, static_argnums=0)
+def train_seeds(agent: NNAgent, keys: jax.Array, transitions: Batch) -> TrainState:
+    return jax.vmap(partial(train, agent), in_axes=(0, None))(keys, transitions)
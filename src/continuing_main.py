@@ -109,6 +109,7 @@ for idx in indices:
             avg_reward = collector.get_last('reward')
             logger.debug(f'{step} {avg_reward} {avg_time:.4}ms {int(fps)}')
 
+    agent.close()
     collector.reset()
     # ------------
     # -- Saving --
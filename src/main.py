@@ -124,6 +124,7 @@ for idx in indices:
 
             glue.start()
 
+    agent.close()
     collector.reset()
 
     # ------------
@@ -115,6 +115,7 @@ def execute(exp: OptunaExperiment.ExperimentModel, config_id: int, internal_seed
     if glue.num_steps > 0:
         score += (glue.total_reward * (glue.num_steps / exp.evaluation_steps))
 
+    agent.close()
     collector.reset()
 
     # ------------
@@ -20,6 +20,7 @@ class NetworkBuilder:
         self._params = {
             'phi': self._feat_params,
         }
+        self._heads: List[Tuple[str, hk.Transformed]] = []
 
         self._retrieved_params = False
 
@@ -27,6 +28,28 @@ class NetworkBuilder:
         self._retrieved_params = True
         return self._params
 
+    # builds a pure function from an rng key to a fresh set of parameters
+    # with the same structure as `getParams`. Calling it with `PRNGKey(seed)`
+    # reproduces `getParams` exactly, and it can be vmapped over keys.
+    def getInitializer(self):
+        self._retrieved_params = True
+        sample_in = jnp.zeros((1,) + self._input_shape)
+        heads = list(self._heads)
+
+        def _inner(rng: jax.Array):
+            rng, feat_rng = jax.random.split(rng)
+            feat_params = self._feat_net.init(feat_rng, sample_in)
+            sample_phi = self._feat_net.apply(feat_params, sample_in).out
+
+            params = {'phi': feat_params}
+            for name, h_net in heads:
+                rng, h_rng = jax.random.split(rng)
+                params[name] = h_net.init(h_rng, sample_phi)
+
+            return params
+
+        return _inner
+
     def getFeatureFunction(self):
         def _inner(params: Any, x: jax.Array | np.ndarray):
             return self._feat_net.apply(params['phi'], x)
@@ -57,6 +80,7 @@ class NetworkBuilder:
         name = name or _state.get('name')
         assert name is not None, 'Could not detect name from module'
         self._params[name] = h_params
+        self._heads.append((name, h_net))
 
         def _inner(params: Any, x: jax.Array):
             return h_net.apply(params[name], x)
@@ -107,7 +131,8 @@ def buildFeatureNetwork(inputs: Tuple, params: Dict[str, Any], rng: Any):
         elif name == 'AtariNet':
             w_init = hk.initializers.Orthogonal(np.sqrt(2))
             layers = [
-                lambda x: x.astype(np.float32),
+                # raw frames come in as integers, anything else is already in the compute dtype
+                lambda x: x.astype(np.float32) if jnp.issubdtype(x.dtype, jnp.integer) else x,
                 make_conv(32, (8, 8), (4, 4)),
                 jax.nn.relu,
                 make_conv(64, (4, 4), (2, 2)),
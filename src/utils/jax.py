@@ -1,5 +1,4 @@
-from inspect import signature, Parameter
-from typing import Callable, List, NamedTuple, Sequence, TypeVar, Union
+from typing import NamedTuple
 import numpy as np
 
 import jax
@@ -16,35 +15,32 @@ Batch = NamedTuple('Batch', [
 def mse_loss(pred: np.ndarray, target: np.ndarray):
     return 0.5 * jnp.mean(jnp.square(pred - target))
 
-def huber_loss(tau: float, pred: np.ndarray, target: np.ndarray):
+# elementwise huber loss, useful when samples need to be re-weighted before reducing
+def huber(tau: float, pred: np.ndarray, target: np.ndarray):
     diffs = jnp.abs(pred - target)
 
     quadratic = jnp.minimum(diffs, tau)
     linear = diffs - quadratic
 
-    losses = 0.5 * quadratic**2 + tau * linear
+    return 0.5 * quadratic**2 + tau * linear
 
-    return jnp.mean(losses)
-
-def takeAlongAxis(a: np.ndarray, ind: np.ndarray):
-    return jnp.squeeze(jnp.take_along_axis(a, ind[..., None], axis=-1), axis=-1)
+# cast every floating point leaf of a pytree, leaving integer leaves untouched
+def cast_floats(tree, dtype):
+    def _cast(x):
+        if jnp.issubdtype(x.dtype, jnp.floating):
+            return x.astype(dtype)
 
+        return x
 
-F = TypeVar('F', bound=Callable)
-def vmap_except(f: F, exclude: Sequence[str]) -> F:
-    sig = signature(f)
-    args = [
-        k for k, p in sig.parameters.items() if p.default is Parameter.empty
-    ]
+    return jax.tree_util.tree_map(_cast, tree)
 
-    total: List[Union[int, None]] = [0] * len(args)
-    for i, k in enumerate(args):
-        if k in exclude:
-            total[i] = None
-
-    return jax.vmap(f, in_axes=total)
+def takeAlongAxis(a: np.ndarray, ind: np.ndarray):
+    return jnp.squeeze(jnp.take_along_axis(a, ind[..., None], axis=-1), axis=-1)
 
 
-def argmax_with_random_tie_breaking(preferences):
+# epsilon-greedy probabilities, splitting the greedy mass evenly among ties
+# the mixture is folded into the tie-breaking normalization so pi is built in one pass
+def egreedy_with_random_tie_breaking(preferences, epsilon: float):
     optimal_actions = (preferences == preferences.max(axis=-1, keepdims=True))
-    return optimal_actions / optimal_actions.sum(axis=-1, keepdims=True)
+    counts = optimal_actions.sum(axis=-1, keepdims=True)
+    return optimal_actions * ((1.0 - epsilon) / counts) + (epsilon / preferences.shape[-1])
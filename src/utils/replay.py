@@ -0,0 +1,235 @@
+import jax
+import numpy as np
+import jax.numpy as jnp
+import utils.chex as cxu
+
+from typing import Any, NamedTuple, Tuple
+from ReplayTables.interface import Timestep
+from ReplayTables.ingress.LagBuffer import LagBuffer
+from utils.jax import Batch
+
+
+# a fixed-size uniform replay buffer stored entirely as device arrays
+# so that adding and sampling can live inside a jit-compiled training loop
+@cxu.dataclass
+class ReplayState:
+    x: jax.Array
+    a: jax.Array
+    xp: jax.Array
+    r: jax.Array
+    gamma: jax.Array
+    write_idx: jax.Array
+    size: jax.Array
+
+
+# keep only the columns the losses read, so nothing else
+# (e.g. ReplayTables' eid or terminal columns) is sent to the device
+def as_batch(batch) -> Batch:
+    return Batch(
+        x=batch.x,
+        a=batch.a,
+        xp=batch.xp,
+        r=batch.r,
+        gamma=batch.gamma,
+    )
+
+
+def init_replay(max_size: int, observations: Tuple[int, ...]) -> ReplayState:
+    # zero-initialized so that never-written slots can't leak NaNs into a loss
+    return ReplayState(
+        x=jnp.zeros((max_size,) + tuple(observations), dtype=jnp.float32),
+        a=jnp.zeros(max_size, dtype=jnp.int32),
+        xp=jnp.zeros((max_size,) + tuple(observations), dtype=jnp.float32),
+        r=jnp.zeros(max_size, dtype=jnp.float32),
+        gamma=jnp.zeros(max_size, dtype=jnp.float32),
+        write_idx=jnp.array(0, dtype=jnp.int32),
+        size=jnp.array(0, dtype=jnp.int32),
+    )
+
+
+def add_transition(state: ReplayState, transition: Batch) -> ReplayState:
+    max_size = state.x.shape[0]
+    i = state.write_idx
+
+    return ReplayState(
+        x=state.x.at[i].set(transition.x),
+        a=state.a.at[i].set(transition.a),
+        xp=state.xp.at[i].set(transition.xp),
+        r=state.r.at[i].set(transition.r),
+        gamma=state.gamma.at[i].set(transition.gamma),
+        write_idx=(i + 1) % max_size,
+        size=jnp.minimum(state.size + 1, max_size),
+    )
+
+
+def sample_batch(state: ReplayState, key: jax.Array, batch_size: int) -> Batch:
+    idxs = jax.random.randint(key, (batch_size,), 0, state.size)
+
+    return Batch(
+        x=jnp.take(state.x, idxs, axis=0),
+        a=jnp.take(state.a, idxs, axis=0),
+        xp=jnp.take(state.xp, idxs, axis=0),
+        r=jnp.take(state.r, idxs, axis=0),
+        gamma=jnp.take(state.gamma, idxs, axis=0),
+    )
+
+
+# ------------------------------
+# -- Observation quantization --
+# ------------------------------
+# integer storage dtypes hold observations from [0, 1] quantized onto [0, max]
+# e.g. round(x * 255) for uint8. Float storage dtypes are a plain cast
+def obs_scale(dtype: Any) -> float:
+    if dtype is not None and np.issubdtype(np.dtype(dtype), np.integer):
+        return float(np.iinfo(dtype).max)
+
+    return 1.
+
+# no range check here, this also runs on every action.
+# The replay buffer checks each observation once when it is written
+def quantize_obs(x: Any, dtype: Any) -> np.ndarray:
+    x = np.asarray(x)
+    scale = obs_scale(dtype)
+
+    if scale != 1:
+        x = np.round(x * scale)
+
+    return x.astype(dtype)
+
+# maps quantized observations back to [0, 1], inside the jit-compiled networks
+def dequantize_obs(x: jax.Array, scale: float) -> jax.Array:
+    if scale == 1:
+        return x
+
+    return x / scale
+
+
+# ---------------------------
+# -- Host-side ring buffer --
+# ---------------------------
+ReplayBatch = NamedTuple('ReplayBatch', [
+    ('x', np.ndarray),
+    ('a', np.ndarray),
+    ('xp', np.ndarray),
+    ('r', np.ndarray),
+    ('gamma', np.ndarray),
+    ('eid', np.ndarray),
+])
+
+# a uniform replay buffer stored as one preallocated array per column
+# exposes the same interface as the ReplayTables buffers used by the agents
+# so that a sampled minibatch is a single fancy-index per column.
+#
+# Like ReplayTables, every observation is stored once: `x` of one transition
+# is usually `xp` of an earlier one. States go into their own ring in arrival
+# order and transitions hold the rows of their `x` and `xp`. The last row is
+# reserved as an all-zero bootstrap state for terminal transitions
+class RingBuffer:
+    def __init__(self, max_size: int, observations: Tuple[int, ...], lag: int, rng: np.random.Generator, obs_dtype: Any = None):
+        self._max_size = max_size
+        self._observations = tuple(observations)
+        self._obs_dtype = obs_dtype
+        self._obs_scale = obs_scale(obs_dtype)
+        self._lag = LagBuffer(lag)
+        self._rng = rng
+
+        self._a = np.zeros(max_size, dtype=np.int32)
+        self._r = np.zeros(max_size, dtype=np.float32)
+        self._gamma = np.zeros(max_size, dtype=np.float32)
+
+        # every live transition needs its `x` and `xp` to still be stored.
+        # Up to `lag` newer states wait in the LagBuffer for their transitions
+        self._max_states = max_size + lag + 1
+        self._zero_row = self._max_states
+        self._xid = np.zeros(max_size, dtype=np.int64)
+        self._xp_row = np.zeros(max_size, dtype=np.int64)
+
+        # allocated on the first write so that,
+        # unless told otherwise, it keeps the dtype the environment produces
+        self._states: np.ndarray | None = None
+        self._n_states = 0
+
+        # transitions [_start, _i) are live
+        self._start = 0
+        self._i = 0
+
+    def size(self) -> int:
+        return self._i - self._start
+
+    def flush(self):
+        self._lag.flush()
+
+    def add_step(self, step: Timestep):
+        # LagBuffer numbers every non-None observation in arrival order,
+        # so the state with xid `k` always lives in row `k % max_states`
+        if step.x is not None:
+            self._add_state(step.x)
+
+        for exp in self._lag.add(step):
+            self._add(exp.xid, exp.a, exp.n_xid, exp.r, exp.gamma)
+
+    def _add_state(self, x):
+        if self._obs_dtype is not None:
+            x = np.asarray(x)
+
+            # refuse rather than wrap or truncate, either would silently destroy the observation
+            if self._obs_scale != 1:
+                assert np.all((x >= 0) & (x <= 1)), f'Only observations in [0, 1] can be stored as {self._obs_dtype}. Leave obs_dtype unset for integer-valued observations'
+
+            x = quantize_obs(x, self._obs_dtype)
+
+        if self._states is None:
+            dtype = self._obs_dtype or np.asarray(x).dtype
+            self._states = np.zeros((self._max_states + 1,) + self._observations, dtype=dtype)
+
+        xid = self._n_states
+        self._states[xid % self._max_states] = x
+        self._n_states += 1
+
+        # episodes cut off without a terminal leave a few states that no transition
+        # uses. If they pushed the ring around far enough, drop the oldest transitions
+        # rather than let them point at overwritten states
+        while self.size() > 0 and self._xid[self._start % self._max_size] <= xid - self._max_states:
+            self._start += 1
+
+    def _add(self, xid, a, n_xid, r, gamma):
+        i = self._i % self._max_size
+        self._xid[i] = xid
+        self._a[i] = a
+        self._r[i] = r
+        self._gamma[i] = gamma
+        self._xp_row[i] = self._zero_row if n_xid is None else n_xid % self._max_states
+
+        self._i += 1
+        self._start = max(self._start, self._i - self._max_size)
+
+    def _rows(self, n: int | Tuple[int, int]) -> np.ndarray:
+        return (self._start + self._rng.integers(0, self.size(), size=n)) % self._max_size
+
+    def sample(self, n: int) -> ReplayBatch:
+        return self._gather(self._rows(n))
+
+    # k independent minibatches from a single rng call and one gather per column
+    # every column gains a leading (k,) axis
+    def sample_k(self, n: int, k: int) -> ReplayBatch:
+        return self._gather(self._rows((k, n)))
+
+    def _gather(self, idxs: np.ndarray) -> ReplayBatch:
+        assert self._states is not None
+
+        return ReplayBatch(
+            x=self._states[self._xid[idxs] % self._max_states],
+            a=self._a[idxs],
+            xp=self._states[self._xp_row[idxs]],
+            r=self._r[idxs],
+            gamma=self._gamma[idxs],
+            eid=idxs,
+        )
+
+    # samples are uniform, so no importance sampling correction is needed
+    def isr_weights(self, eid: np.ndarray):
+        return np.ones(np.shape(eid), dtype=np.float32)
+
+    # priorities have no effect on uniform sampling
+    def update_batch(self, batch: ReplayBatch, **kwargs):
+        ...
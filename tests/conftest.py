@@ -0,0 +1,64 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import jax
+import pytest
+import numpy as np
+import jax.numpy as jnp
+
+from PyExpUtils.collection.Collector import Collector
+from PyExpUtils.collection.Sampler import Ignore
+
+from utils.jax import Batch
+
+OBSERVATIONS = (4,)
+ACTIONS = 2
+
+# a deliberately tiny configuration so that compiling and training stay fast
+def agent_params(**overrides):
+    params = {
+        'epsilon': 0.1,
+        'target_refresh': 4,
+        'buffer_type': 'uniform',
+        'buffer_size': 64,
+        'batch': 8,
+        'optimizer': {
+            'name': 'ADAM',
+            'alpha': 0.001,
+            'beta1': 0.9,
+            'beta2': 0.999,
+        },
+        'representation': {
+            'type': 'TwoLayerRelu',
+            'hidden': 16,
+        },
+    }
+
+    params |= overrides
+    return params
+
+@pytest.fixture
+def make_agent():
+    def _build(Agent, seed: int = 0, **overrides):
+        collector = Collector(config={}, default=Ignore())
+        return Agent(OBSERVATIONS, ACTIONS, agent_params(**overrides), collector, seed)
+
+    return _build
+
+# a fixed stream of `n` random transitions, stacked along a leading axis
+def make_transitions(n: int, seed: int = 0) -> Batch:
+    rng = np.random.default_rng(seed)
+
+    return Batch(
+        x=jnp.asarray(rng.random((n,) + OBSERVATIONS, dtype=np.float32)),
+        a=jnp.asarray(rng.integers(0, ACTIONS, size=n, dtype=np.int32)),
+        xp=jnp.asarray(rng.random((n,) + OBSERVATIONS, dtype=np.float32)),
+        r=jnp.asarray(rng.standard_normal(n, dtype=np.float32)),
+        gamma=jnp.full(n, 0.99, dtype=jnp.float32),
+    )
+
+def leaves_equal(a, b) -> bool:
+    return all(
+        np.array_equal(x, y) for x, y in zip(jax.tree_util.tree_leaves(a), jax.tree_util.tree_leaves(b))
+    )
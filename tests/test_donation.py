@@ -0,0 +1,40 @@
+import numpy as np
+import jax
+
+from algorithms.nn.DQN import DQN
+from conftest import make_transitions, leaves_equal
+
+tree_leaves = jax.tree_util.tree_leaves
+
+def deleted(tree):
+    return [leaf.is_deleted() for leaf in tree_leaves(tree)]
+
+def test_compute_update_donates_params_and_optim_but_not_target(make_agent):
+    agent = make_agent(DQN, target_refresh=4)
+    batch = make_transitions(agent.batch_size)
+    weights = np.ones(agent.batch_size, dtype=np.float32)
+
+    state = agent.state
+    new_state, _ = agent._computeUpdate(state.params, state.optim, state.target_params, batch, weights, 1)
+
+    assert all(deleted(state.params))
+    assert all(deleted(state.optim))
+    assert not any(deleted(state.target_params))
+    assert not any(deleted(new_state))
+
+def test_refreshed_target_survives_the_next_update(make_agent):
+    agent = make_agent(DQN, target_refresh=4)
+    batch = make_transitions(agent.batch_size)
+    weights = np.ones(agent.batch_size, dtype=np.float32)
+
+    # on a refresh step the target is a copy of the new params,
+    # it must not share buffers that the next update donates
+    state = agent.state
+    state, _ = agent._computeUpdate(state.params, state.optim, state.target_params, batch, weights, 4)
+    assert leaves_equal(state.params, state.target_params)
+
+    target = state.target_params
+    agent._computeUpdate(state.params, state.optim, state.target_params, batch, weights, 5)
+
+    assert all(deleted(state.params))
+    assert not any(deleted(target))
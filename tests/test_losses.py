@@ -0,0 +1,159 @@
+import jax
+import pytest
+import numpy as np
+import jax.numpy as jnp
+
+from algorithms.nn.DQN import DQN, q_loss
+from algorithms.nn.EQRC import EQRC, qc_loss
+from conftest import make_transitions
+
+B = 16
+A = 4
+EPSILON = 0.1
+
+# -----------------------------------------------
+# -- Original per-sample formulations, vmapped --
+# -----------------------------------------------
+def per_sample_q_loss(q, a, r, gamma, qp):
+    vp = qp.max()
+    target = r + gamma * vp
+    target = jax.lax.stop_gradient(target)
+    delta = target - q[a]
+
+    diff = jnp.abs(q[a] - target)
+    quadratic = jnp.minimum(diff, 1.0)
+    loss = 0.5 * quadratic**2 + (diff - quadratic)
+
+    return loss, {
+        'delta': delta,
+    }
+
+def per_sample_qc_loss(q, a, r, gamma, qtp1, h, epsilon):
+    optimal_actions = (qtp1 == qtp1.max())
+    pi = optimal_actions / optimal_actions.sum()
+
+    pi = (1.0 - epsilon) * pi + (epsilon / qtp1.shape[0])
+    pi = jax.lax.stop_gradient(pi)
+
+    vtp1 = qtp1.dot(pi)
+    target = r + gamma * vtp1
+    target = jax.lax.stop_gradient(target)
+
+    delta = target - q[a]
+    delta_hat = h[a]
+
+    v_loss = 0.5 * delta**2 + gamma * jax.lax.stop_gradient(delta_hat) * vtp1
+    h_loss = 0.5 * (jax.lax.stop_gradient(delta) - delta_hat)**2
+
+    return v_loss, h_loss, {
+        'delta': delta,
+        'h': delta_hat,
+    }
+
+def inputs(seed: int):
+    rng = np.random.default_rng(seed)
+
+    # small integers, so many rows of qp have tied maxima
+    qp = rng.integers(0, 3, size=(B, A)).astype(np.float32)
+    assert np.any((qp == qp.max(axis=-1, keepdims=True)).sum(axis=-1) > 1)
+
+    return (
+        jnp.asarray(rng.standard_normal((B, A), dtype=np.float32)),
+        jnp.asarray(rng.integers(0, A, size=B, dtype=np.int32)),
+        jnp.asarray(rng.standard_normal(B, dtype=np.float32)),
+        jnp.asarray(rng.choice([0., 0.99], size=B).astype(np.float32)),
+        jnp.asarray(qp),
+        jnp.asarray(rng.standard_normal((B, A), dtype=np.float32)),
+    )
+
+def assert_trees_close(a, b):
+    for x, y in zip(jax.tree_util.tree_leaves(a), jax.tree_util.tree_leaves(b)):
+        assert np.allclose(x, y, atol=1e-5)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_q_loss_matches_per_sample(seed):
+    q, a, r, gamma, qp, _ = inputs(seed)
+
+    assert_trees_close(
+        q_loss(q, a, r, gamma, qp),
+        jax.vmap(per_sample_q_loss)(q, a, r, gamma, qp),
+    )
+
+    # and so do the gradients through q
+    grad = jax.grad(lambda q: q_loss(q, a, r, gamma, qp)[0].sum())(q)
+    expected = jax.grad(lambda q: jax.vmap(per_sample_q_loss)(q, a, r, gamma, qp)[0].sum())(q)
+    assert np.allclose(grad, expected, atol=1e-5)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_qc_loss_matches_per_sample(seed):
+    q, a, r, gamma, qtp1, h = inputs(seed)
+    per_sample = jax.vmap(per_sample_qc_loss, in_axes=(0, 0, 0, 0, 0, 0, None))
+
+    assert_trees_close(
+        qc_loss(q, a, r, gamma, qtp1, h, EPSILON),
+        per_sample(q, a, r, gamma, qtp1, h, EPSILON),
+    )
+
+    def total(f):
+        def _inner(q, h):
+            v_loss, h_loss, _ = f(q, a, r, gamma, qtp1, h, EPSILON)
+            return v_loss.mean() + h_loss.mean()
+
+        return jax.grad(_inner, argnums=(0, 1))(q, h)
+
+    assert_trees_close(total(qc_loss), total(per_sample))
+
+# ---------------------------
+# -- Full agent objectives --
+# ---------------------------
+# EQRC's objective as originally written: separate forward passes
+# for x and xp, and a separate mean for each half of the loss
+def separate_eqrc_loss(agent, params, batch):
+    phi = agent.phi(params, batch.x).out
+    q = agent.q(params, phi)
+    h = agent.h(params, phi)
+
+    phi_p = agent.phi(params, batch.xp).out
+    qp = agent.q(params, phi_p)
+
+    per_sample = jax.vmap(per_sample_qc_loss, in_axes=(0, 0, 0, 0, 0, 0, None))
+    v_loss, h_loss, _ = per_sample(q, batch.a, batch.r, batch.gamma, qp, h, agent.epsilon)
+
+    return v_loss.mean() + h_loss.mean()
+
+def test_eqrc_loss_matches_separate_passes(make_agent):
+    agent = make_agent(EQRC)
+    batch = make_transitions(B)
+
+    # EQRC's heads start at zero, perturb them so the comparison isn't trivial
+    key = jax.random.PRNGKey(0)
+    params = jax.tree_util.tree_map(
+        lambda p: p + 0.1 * jax.random.normal(key, p.shape),
+        agent.state.params,
+    )
+
+    loss, _ = agent._loss(params, batch)
+    grad = jax.grad(lambda p: agent._loss(p, batch)[0])(params)
+
+    assert np.allclose(loss, separate_eqrc_loss(agent, params, batch), atol=1e-5)
+    assert_trees_close(grad, jax.grad(separate_eqrc_loss, argnums=1)(agent, params, batch))
+
+def test_dqn_loss_matches_per_sample(make_agent):
+    agent = make_agent(DQN)
+    batch = make_transitions(B)
+    weights = jnp.asarray(np.random.default_rng(0).random(B, dtype=np.float32))
+    params = agent.state.params
+    target = agent.state.target_params
+
+    def expected(params):
+        qs = agent.q(params, agent.phi(params, batch.x).out)
+        qsp = agent.q(target, agent.phi(target, batch.xp).out)
+        losses, _ = jax.vmap(per_sample_q_loss)(qs, batch.a, batch.r, batch.gamma, qsp)
+        return jnp.mean(weights * losses)
+
+    loss, _ = agent._loss(params, target, batch, weights)
+    assert np.allclose(loss, expected(params), atol=1e-5)
+    assert_trees_close(
+        jax.grad(lambda p: agent._loss(p, target, batch, weights)[0])(params),
+        jax.grad(expected)(params),
+    )
@@ -0,0 +1,60 @@
+import jax
+import pytest
+import numpy as np
+
+from algorithms.nn.DQN import DQN
+from algorithms.nn.EQRC import EQRC
+from ReplayTables.interface import Timestep
+from utils.replay import RingBuffer, quantize_obs, dequantize_obs, obs_scale
+
+def test_uint8_quantizes_unit_interval():
+    x = np.random.default_rng(0).random(1000, dtype=np.float32)
+    q = quantize_obs(x, 'uint8')
+
+    assert q.dtype == np.uint8
+    assert np.max(np.abs(dequantize_obs(q, obs_scale('uint8')) - x)) <= 0.5 / 255 + 1e-7
+
+def write(buffer: RingBuffer, x):
+    buffer.add_step(Timestep(x=np.asarray(x), a=0, r=None, gamma=1., terminal=False))
+
+def test_out_of_range_observations_are_rejected():
+    buffer = RingBuffer(8, (2,), 1, np.random.default_rng(0), obs_dtype='uint8')
+    with pytest.raises(AssertionError):
+        write(buffer, [0.5, 2.])
+
+    # integer frames must be stored in their own dtype, not rescaled
+    buffer = RingBuffer(8, (3,), 1, np.random.default_rng(0), obs_dtype='uint8')
+    with pytest.raises(AssertionError):
+        write(buffer, [0, 128, 255])
+
+def test_compiled_loop_rejects_obs_dtype(make_agent):
+    agent = make_agent(DQN, obs_dtype='uint8')
+
+    with pytest.raises(AssertionError):
+        agent.init_train_state(jax.random.PRNGKey(0))
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_agent_stores_and_acts_on_the_same_states(make_agent, Agent):
+    agent = make_agent(Agent, obs_dtype='uint8')
+    reference = make_agent(Agent)
+
+    rng = np.random.default_rng(0)
+    xs = rng.random((20, 4), dtype=np.float32)
+
+    agent.start(xs[0])
+    for x in xs[1:]:
+        agent.step(0., x, {})
+
+    # the replayed observations are the quantized inputs, not zeros
+    stored = agent.buffer._states[:len(xs)]
+    assert stored.dtype == np.uint8
+    assert np.array_equal(stored, quantize_obs(xs, 'uint8'))
+
+    # acting dequantizes inside the network, matching an unquantized agent on the same grid
+    x = np.round(xs[0] * 255) / 255
+    params = jax.tree_util.tree_map(np.asarray, agent.state.params)
+    assert np.allclose(agent.values(x), reference._values(params, x.astype(np.float32)), atol=1e-5)
+
+def test_obs_dtype_requires_uniform_replay(make_agent):
+    with pytest.raises(AssertionError):
+        make_agent(DQN, obs_dtype='uint8', buffer_type='per')
@@ -0,0 +1,37 @@
+import jax
+import pytest
+import numpy as np
+
+from algorithms.nn.DQN import DQN
+from algorithms.nn.EQRC import EQRC
+from conftest import leaves_equal
+
+def test_prefetch_is_off_for_multi_step_updates(make_agent):
+    agent = make_agent(DQN, prefetch=True, n_jitted_steps=4)
+
+    assert not agent.prefetch
+    assert agent._prefetcher is None
+
+def test_close_shuts_down_prefetcher(make_agent):
+    agent = make_agent(DQN, prefetch=True)
+    assert agent._prefetcher is not None
+
+    agent.close()
+
+    with pytest.raises(RuntimeError):
+        agent._prefetcher.submit(lambda: None)
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_prefetched_batches_drive_updates(make_agent, Agent):
+    agent = make_agent(Agent, prefetch=True)
+    before = jax.tree_util.tree_map(np.array, agent.state.params)
+
+    xs = np.random.default_rng(0).random((3 * agent.batch_size, 4), dtype=np.float32)
+    agent.start(xs[0])
+    for x in xs[1:]:
+        agent.step(1., x, {})
+
+    agent.close()
+
+    assert agent.updates > 0
+    assert not leaves_equal(before, agent.state.params)
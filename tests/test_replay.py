@@ -0,0 +1,138 @@
+import pytest
+import numpy as np
+
+from ReplayTables.interface import Timestep
+from algorithms.nn.DQN import DQN
+from utils.replay import RingBuffer
+
+GAMMA = 0.9
+
+def build(max_size: int = 8, lag: int = 1, obs_dtype=None):
+    return RingBuffer(max_size, (2,), lag, np.random.default_rng(0), obs_dtype=obs_dtype)
+
+# observation t of an episode is [t, t], action t is t, and reward t+1 is 1
+def run_episode(buffer: RingBuffer, steps: int, terminal: bool = True, offset: int = 0, dtype=np.float32):
+    buffer.flush()
+    buffer.add_step(Timestep(x=np.full(2, offset, dtype=dtype), a=offset, r=None, gamma=GAMMA, terminal=False))
+
+    for t in range(offset + 1, offset + steps):
+        buffer.add_step(Timestep(x=np.full(2, t, dtype=dtype), a=t, r=1., gamma=GAMMA, terminal=False))
+
+    if terminal:
+        buffer.add_step(Timestep(x=None, a=-1, r=1., gamma=0., terminal=True))
+    else:
+        t = offset + steps
+        buffer.add_step(Timestep(x=np.full(2, t, dtype=dtype), a=t, r=1., gamma=GAMMA, terminal=False))
+
+def everything(buffer: RingBuffer):
+    return buffer.sample(1000)
+
+def test_transitions_pair_states_with_their_successors():
+    buffer = build()
+    run_episode(buffer, 5, terminal=False)
+
+    batch = everything(buffer)
+    assert buffer.size() == 5
+    assert np.array_equal(batch.xp[:, 0], batch.x[:, 0] + 1)
+    assert np.array_equal(batch.a, batch.x[:, 0])
+    assert np.allclose(batch.r, 1.)
+    assert np.allclose(batch.gamma, GAMMA)
+
+def test_terminal_transitions_bootstrap_from_zeros():
+    buffer = build()
+    run_episode(buffer, 3)
+
+    batch = everything(buffer)
+    last = batch.x[:, 0] == 2
+    assert np.all(batch.xp[last] == 0)
+    assert np.all(batch.gamma[last] == 0)
+    assert np.array_equal(batch.xp[~last, 0], batch.x[~last, 0] + 1)
+
+def test_wraparound_keeps_only_the_newest_transitions():
+    buffer = build(max_size=8)
+    run_episode(buffer, 30, terminal=False)
+
+    batch = everything(buffer)
+    assert buffer.size() == 8
+    assert set(batch.x[:, 0]) == set(range(22, 30))
+    assert np.array_equal(batch.xp[:, 0], batch.x[:, 0] + 1)
+
+def test_n_step_lag_accumulates_returns():
+    buffer = build(lag=3)
+    run_episode(buffer, 10, terminal=False)
+
+    batch = everything(buffer)
+    assert np.array_equal(batch.xp[:, 0], batch.x[:, 0] + 3)
+    assert np.allclose(batch.r, 1 + GAMMA + GAMMA**2)
+    assert np.allclose(batch.gamma, GAMMA**3)
+
+def test_n_step_lag_truncates_at_terminals():
+    buffer = build(lag=3)
+    run_episode(buffer, 4)
+
+    batch = everything(buffer)
+    assert buffer.size() == 4
+    for x, xp, r in zip(batch.x[:, 0], batch.xp[:, 0], batch.r):
+        # the last three transitions all bootstrap from the terminal zero state
+        steps = min(3, 4 - x)
+        assert np.isclose(r, sum(GAMMA**i for i in range(int(steps))))
+        assert xp == (x + 3 if x + 3 < 4 else 0)
+
+def test_truncated_episodes_never_point_at_overwritten_states():
+    buffer = build(max_size=8, lag=2)
+
+    # every cut-off episode leaves states behind that no transition uses
+    for ep in range(20):
+        run_episode(buffer, 3, terminal=False, offset=100 * ep)
+
+        batch = everything(buffer)
+        assert np.array_equal(batch.xp[:, 0], batch.x[:, 0] + 2)
+        assert np.array_equal(batch.a, batch.x[:, 0])
+
+def test_each_state_is_stored_once():
+    buffer = build(max_size=8, lag=3)
+    run_episode(buffer, 30, terminal=False)
+
+    assert buffer._states is not None
+    assert buffer._states.shape[0] == 8 + 3 + 2
+
+def test_sample_shapes():
+    buffer = build()
+    run_episode(buffer, 10, terminal=False)
+
+    batch = buffer.sample(5)
+    assert batch.x.shape == (5, 2)
+    assert batch.xp.shape == (5, 2)
+    assert batch.a.shape == batch.r.shape == batch.gamma.shape == batch.eid.shape == (5,)
+
+    batch = buffer.sample_k(5, 3)
+    assert batch.x.shape == (3, 5, 2)
+    assert batch.xp.shape == (3, 5, 2)
+    assert batch.a.shape == batch.r.shape == batch.gamma.shape == batch.eid.shape == (3, 5)
+    assert buffer.isr_weights(batch.eid).shape == (3, 5)
+
+def test_state_dtype_comes_from_the_first_write():
+    buffer = build()
+    run_episode(buffer, 3, dtype=np.uint8)
+    assert buffer.sample(4).x.dtype == np.uint8
+
+    buffer = build(obs_dtype='float16')
+    run_episode(buffer, 3)
+    assert buffer.sample(4).x.dtype == np.float16
+
+@pytest.mark.parametrize('buffer_type', ['uniform', 'per'])
+def test_agent_terminals_bootstrap_from_zeros(make_agent, buffer_type):
+    agent = make_agent(DQN, buffer_type=buffer_type)
+    rng = np.random.default_rng(0)
+
+    for _ in range(6):
+        agent.start(rng.random(4, dtype=np.float32) + 1)
+        for _ in range(4):
+            agent.step(1., rng.random(4, dtype=np.float32) + 1, {})
+        agent.end(1., {})
+
+    batch = agent.buffer.sample(200)
+    terminal = batch.gamma == 0
+    assert np.any(terminal)
+    assert np.all(batch.xp[terminal] == 0)
+    assert np.all(batch.xp[~terminal] >= 1)
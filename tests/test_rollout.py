@@ -0,0 +1,64 @@
+import jax
+import pytest
+import numpy as np
+
+from algorithms.nn.DQN import DQN
+from algorithms.nn.EQRC import EQRC
+from conftest import make_transitions, leaves_equal
+
+N = 32
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_rollout_follows_update_schedule(make_agent, Agent):
+    agent = make_agent(Agent)
+    carry = agent.init_train_state(jax.random.PRNGKey(0))
+
+    carry, delta = agent.rollout(carry, make_transitions(N))
+
+    # one update per step once the replay holds more than a single batch
+    assert int(carry.steps) == N
+    assert int(carry.updates) == N - agent.batch_size
+    assert int(carry.replay.size) == N
+    assert delta.shape == (N, agent.batch_size)
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_agent_acts_with_rolled_out_state(make_agent, Agent):
+    agent = make_agent(Agent)
+    transitions = make_transitions(N)
+    x = np.asarray(transitions.x[0])
+    before = agent.values(x)
+
+    carry = agent.init_train_state(jax.random.PRNGKey(0))
+    carry, _ = agent.rollout(carry, transitions)
+    agent.set_train_state(carry)
+
+    assert agent.steps == N
+    assert agent.updates == N - agent.batch_size
+    assert np.allclose(agent.values(x), agent._values(carry.state.params, x))
+    assert not np.allclose(agent.values(x), before)
+
+    # the next rollout consumes `carry`, the agent must keep its own copy
+    carry, _ = agent.rollout(carry, transitions)
+    agent.values(x)
+    agent.set_train_state(carry)
+    assert agent.steps == 2 * N
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_rollout_continues_from_agent_state(make_agent, Agent):
+    agent = make_agent(Agent)
+    x = np.zeros(4, dtype=np.float32)
+    before = agent.values(x)
+
+    carry = agent.get_train_state(jax.random.PRNGKey(0))
+    assert leaves_equal(carry.state.params, agent.state.params)
+
+    carry, _ = agent.rollout(carry, make_transitions(N))
+
+    # the agent's own state is untouched by the donated carry
+    assert np.allclose(agent.values(x), before)
+
+def test_rollout_rejects_unsupported_replay(make_agent):
+    agent = make_agent(DQN, n_step=3)
+
+    with pytest.raises(AssertionError):
+        agent.init_train_state(jax.random.PRNGKey(0))
@@ -0,0 +1,59 @@
+import jax
+import pytest
+import numpy as np
+
+from algorithms.nn.DQN import DQN
+from algorithms.nn.EQRC import EQRC
+from algorithms.nn.NNAgent import train, train_seeds
+from conftest import make_transitions, leaves_equal
+
+N = 32
+SEEDS = 3
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_initializer_reproduces_agent_params(make_agent, Agent):
+    agent = make_agent(Agent, seed=7)
+    params = agent._init_params(jax.random.PRNGKey(7))
+
+    assert leaves_equal(params, agent.state.params)
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_train_seeds_matches_independent_runs(make_agent, Agent):
+    agent = make_agent(Agent)
+    transitions = make_transitions(N)
+    keys = jax.random.split(jax.random.PRNGKey(0), SEEDS)
+
+    out = train_seeds(agent, keys, transitions)
+
+    # every leaf gains a leading seed axis
+    assert out.steps.shape == (SEEDS,)
+    assert np.all(out.steps == N)
+    assert np.all(out.updates == N - agent.batch_size)
+
+    for i in range(SEEDS):
+        single = train(agent, keys[i], transitions)
+        for a, b in zip(jax.tree_util.tree_leaves(single), jax.tree_util.tree_leaves(out)):
+            assert np.allclose(a, b[i], atol=1e-5)
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+def test_seeds_share_transitions_but_not_init(make_agent, Agent):
+    agent = make_agent(Agent)
+    keys = jax.random.split(jax.random.PRNGKey(0), SEEDS)
+
+    out = train_seeds(agent, keys, make_transitions(N))
+
+    # the transition stream is fixed, so every seed holds the same replay contents
+    for i in range(1, SEEDS):
+        assert np.array_equal(out.replay.x[0], out.replay.x[i])
+        assert np.array_equal(out.replay.r[0], out.replay.r[i])
+
+    # while initialization and replay sampling differ per seed
+    phi = [jax.tree_util.tree_leaves(out.state.params['phi'])[0][i] for i in range(SEEDS)]
+    assert not np.allclose(phi[0], phi[1])
+
+    # and the same key always gives the same agent
+    same = train_seeds(agent, keys[:1].repeat(2, axis=0), make_transitions(N))
+    assert leaves_equal(
+        jax.tree_util.tree_map(lambda x: x[0], same.state),
+        jax.tree_util.tree_map(lambda x: x[1], same.state),
+    )
@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+
+from algorithms.nn.DQN import DQN
+from algorithms.nn.EQRC import EQRC
+
+class CountingCollector:
+    def __init__(self):
+        self.counts = {}
+
+    def collect(self, key, value):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+@pytest.mark.parametrize('Agent', [DQN, EQRC])
+@pytest.mark.parametrize('k', [1, 4])
+def test_one_metric_per_update(make_agent, Agent, k):
+    agent = make_agent(Agent, n_jitted_steps=k)
+    agent.collector = CountingCollector()
+
+    xs = np.random.default_rng(0).random((5 * agent.batch_size, 4), dtype=np.float32)
+    agent.start(xs[0])
+    for x in xs[1:]:
+        agent.step(1., x, {})
+
+    assert agent.updates > 0
+    assert agent.collector.counts['delta'] == agent.updates